@@ -1,20 +1,26 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from typing import Optional
+from functools import lru_cache
 import uvicorn
 import os
 import asyncio
+import time
 from datetime import datetime
 import logging
 import google.generativeai as genai
 from dotenv import load_dotenv
 import base64
 import io
-import json
+import orjson
 import re
 from PIL import Image as PILImage
 import random
+import hashlib
+from cachetools import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -25,22 +31,126 @@ logger = logging.getLogger(__name__)
 
 # Initialize Gemini AI
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+GEMINI_MODEL = genai.GenerativeModel('gemini-2.0-flash-exp')
+
+FLOOD_PROMPT = """
+Analyze this terrain image for flood risk assessment.
+
+Please provide:
+1. Risk Level (Low/Medium/High/Very High)
+2. Description of the risk based on what you see
+3. 3-5 specific recommendations
+4. Estimated elevation in meters
+5. Estimated distance from water bodies in meters
+6. What water bodies or flood risks you can identify in the image
+
+Format your response as JSON with these fields:
+- risk_level
+- description
+- recommendations (array of strings)
+- elevation (number)
+- distance_from_water (number)
+- image_analysis (string describing what you see)
+"""
+
+_JSON_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+_RISK_LEVELS = ("Low", "Medium", "High", "Very High")
+
+# Dedicated generator for simulated values, seeded from os.urandom per worker
+_RNG = random.Random()
+
+# Recommendation sets shared across the simulated and fallback assessments
+_MONITOR_RECOMMENDATIONS = (
+    "Monitor weather conditions",
+    "Stay informed about local alerts"
+)
+_MEDIUM_RECOMMENDATIONS = (
+    "Improve drainage infrastructure",
+    "Consider flood monitoring systems",
+    "Develop emergency response plan"
+)
+_VERY_HIGH_RECOMMENDATIONS = (
+    "Immediate flood protection measures needed",
+    "Consider relocation to higher ground",
+    "Implement comprehensive emergency protocols"
+)
+
+# Largest image side worth sending to Gemini for terrain analysis
+MAX_IMAGE_SIZE = (1024, 1024)
+
+# Upload formats Gemini can take as-is
+GEMINI_IMAGE_TYPES = {"image/jpeg", "image/png", "image/webp"}
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+# Request body limit, allowing for multipart framing around the file
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + 64 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Parsed Gemini analyses keyed by upload content hash
+_ANALYSIS_CACHE = TTLCache(maxsize=1024, ttl=3600)
+
+# Upper bound on concurrent Gemini calls per worker
+GEMINI_MAX_IN_FLIGHT = 16
+_GEMINI_SLOTS = asyncio.Semaphore(GEMINI_MAX_IN_FLIGHT)
+
+async def generate_gemini_content(parts: list):
+    """Call Gemini, limiting how many requests are in flight at once"""
+    async with _GEMINI_SLOTS:
+        return await GEMINI_MODEL.generate_content_async(parts)
+
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson instead of the stdlib json module"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
 
 app = FastAPI(
     title="Flood Detection API",
     description="Simple flood risk assessment using Gemini AI",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=OrjsonResponse
 )
 
-# CORS middleware
+class UploadSizeLimitMiddleware:
+    """Reject oversized uploads to one path by Content-Length before FastAPI parses the body"""
+
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path:
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > self.max_bytes:
+                        response = JSONResponse(status_code=413, content={"detail": "Image is too large"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+# Registered before CORS so the 413 still carries CORS headers
+app.add_middleware(UploadSizeLimitMiddleware, path="/api/analyze/image", max_bytes=MAX_REQUEST_BYTES)
+
+# CORS middleware; set CORS_ORIGINS to a comma-separated list of frontend origins
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "http://localhost:3000").split(",") if origin.strip()]
+if "*" in CORS_ORIGINS:
+    logger.warning("CORS_ORIGINS allows any origin; set it to the frontend origin in production")
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=86400,
 )
 
+# Compress JSON responses large enough to benefit
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=5)
+
 # Pydantic models
 class CoordinateRequest(BaseModel):
     latitude: float
@@ -55,40 +165,94 @@ class AnalysisResponse(BaseModel):
     distance_from_water: float
     message: str
 
-def parse_gemini_response(response_text: str) -> dict:
-    """Parse Gemini AI response and extract structured data"""
+def _default_gemini_payload(response_text: str) -> dict:
+    """Fallback assessment used when the Gemini response holds no usable JSON"""
+    return {
+        "risk_level": "Medium",
+        "description": "Analysis completed",
+        "recommendations": _MONITOR_RECOMMENDATIONS,
+        "elevation": 50.0,
+        "distance_from_water": 1000.0,
+        "image_analysis": response_text
+    }
+
+def parse_gemini_response(response_text: str) -> Optional[dict]:
+    """Parse Gemini AI response and extract structured data, or None if it holds no usable JSON"""
     try:
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if json_match:
-            json_str = json_match.group()
-            parsed_data = json.loads(json_str)
-            return {
-                "risk_level": parsed_data.get("risk_level", "Medium"),
-                "description": parsed_data.get("description", "Analysis completed"),
-                "recommendations": parsed_data.get("recommendations", []),
-                "elevation": parsed_data.get("elevation", 50.0),
-                "distance_from_water": parsed_data.get("distance_from_water", 1000.0),
-                "image_analysis": parsed_data.get("image_analysis", "")
-            }
-        else:
-            return {
-                "risk_level": "Medium",
-                "description": "Analysis completed",
-                "recommendations": ["Monitor weather conditions", "Stay informed about local alerts"],
-                "elevation": 50.0,
-                "distance_from_water": 1000.0,
-                "image_analysis": response_text
-            }
-    except Exception as e:
-        logger.error(f"Error parsing Gemini response: {str(e)}")
+        # Gemini usually returns bare or fenced JSON, so try parsing it directly first
+        json_str = response_text.strip().removeprefix("```json").removesuffix("```").strip()
+        try:
+            parsed_data = orjson.loads(json_str)
+        except orjson.JSONDecodeError:
+            json_match = _JSON_RE.search(json_str)
+            if not json_match:
+                return None
+            parsed_data = orjson.loads(json_match.group())
         return {
-            "risk_level": "Medium",
-            "description": "Analysis completed",
-            "recommendations": ["Monitor weather conditions", "Stay informed about local alerts"],
-            "elevation": 50.0,
-            "distance_from_water": 1000.0,
-            "image_analysis": response_text
+            "risk_level": parsed_data.get("risk_level", "Medium"),
+            "description": parsed_data.get("description", "Analysis completed"),
+            "recommendations": parsed_data.get("recommendations", []),
+            "elevation": parsed_data.get("elevation", 50.0),
+            "distance_from_water": parsed_data.get("distance_from_water", 1000.0),
+            "image_analysis": parsed_data.get("image_analysis", "")
         }
+    except Exception as e:
+        logger.error(f"Error parsing Gemini response: {str(e)}")
+        return None
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """MIME type of a supported image from its leading bytes, or None"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return None
+
+def hash_upload(fp) -> bytes:
+    """Content hash of an uploaded file, leaving it rewound for decoding"""
+    hasher = hashlib.blake2b(digest_size=16)
+    total = 0
+    while chunk := fp.read(UPLOAD_CHUNK_SIZE):
+        total += len(chunk)
+        if total > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        hasher.update(chunk)
+    fp.seek(0)
+    return hasher.digest()
+
+def prepare_image(fp, mime_type: str) -> dict:
+    """Build the Gemini image part for an upload, re-encoding only when it must be downscaled"""
+    image = PILImage.open(fp)
+    passthrough = mime_type in GEMINI_IMAGE_TYPES and image.width <= MAX_IMAGE_SIZE[0] and image.height <= MAX_IMAGE_SIZE[1]
+    if image.format == 'JPEG' and not passthrough:
+        # Let libjpeg decode oversized uploads at a reduced scale
+        image.draft('RGB', MAX_IMAGE_SIZE)
+    # Decode now so corrupt uploads are rejected here rather than at the Gemini call
+    image.load()
+    if passthrough:
+        # Gemini accepts the original bytes, so skip the re-encode
+        fp.seek(0)
+        return {"mime_type": mime_type, "data": fp.read()}
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.thumbnail(MAX_IMAGE_SIZE, PILImage.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+_HEALTH_STATIC = {
+    "status": "healthy",
+    "ai_model": "Gemini 2.0 Flash"
+}
+
+@lru_cache(maxsize=1)
+def _timestamp(second: int) -> str:
+    """ISO timestamp for the given epoch second, formatted once per second"""
+    return datetime.fromtimestamp(second).isoformat()
 
 @app.get("/")
 async def root():
@@ -97,17 +261,13 @@ async def root():
         "message": "Flood Detection API with Gemini AI",
         "version": "1.0.0",
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": _timestamp(int(time.time()))
     }
 
 @app.get("/health")
 async def health_check():
     """Detailed health check"""
-    return {
-        "status": "healthy",
-        "ai_model": "Gemini 2.0 Flash",
-        "timestamp": datetime.now().isoformat()
-    }
+    return _HEALTH_STATIC
 
 @app.post("/api/analyze/image")
 async def analyze_image(file: UploadFile = File(...)):
@@ -115,50 +275,35 @@ async def analyze_image(file: UploadFile = File(...)):
     try:
         logger.info(f"Analyzing image: {file.filename}")
 
-        # Validate file
-        if not file.content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="File must be an image")
+        # Validate file by its magic bytes rather than the client-supplied content type
+        head = await file.read(12)
+        await file.seek(0)
+        mime_type = sniff_image_type(head)
+        if mime_type is None:
+            raise HTTPException(status_code=400, detail="File must be a JPEG, PNG, WebP or GIF image")
 
-        # Read image data
-        image_data = await file.read()
+        # Identical uploads reuse the earlier Gemini analysis
+        cache_key = await asyncio.to_thread(hash_upload, file.file)
+        parsed_data = _ANALYSIS_CACHE.get(cache_key)
+        if parsed_data is None:
+            try:
+                image_part = await asyncio.to_thread(prepare_image, file.file, mime_type)
+            except Exception as img_error:
+                logger.error(f"Error processing image: {str(img_error)}")
+                raise HTTPException(status_code=400, detail="Invalid image format")
 
-        # Convert image to PIL Image
-        try:
-            image = PILImage.open(io.BytesIO(image_data))
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-        except Exception as img_error:
-            logger.error(f"Error processing image: {str(img_error)}")
-            raise HTTPException(status_code=400, detail="Invalid image format")
-
-        prompt = """
-        Analyze this terrain image for flood risk assessment.
-
-        Please provide:
-        1. Risk Level (Low/Medium/High/Very High)
-        2. Description of the risk based on what you see
-        3. 3-5 specific recommendations
-        4. Estimated elevation in meters
-        5. Estimated distance from water bodies in meters
-        6. What water bodies or flood risks you can identify in the image
-
-        Format your response as JSON with these fields:
-        - risk_level
-        - description
-        - recommendations (array of strings)
-        - elevation (number)
-        - distance_from_water (number)
-        - image_analysis (string describing what you see)
-        """
-
-        try:
-            model = genai.GenerativeModel('gemini-2.0-flash-exp')
-            response = model.generate_content([prompt, image])
-            parsed_data = parse_gemini_response(response.text)
-        except Exception as ai_error:
-            logger.error(f"Error calling Gemini AI: {str(ai_error)}")
-            parsed_data = generate_image_risk_assessment()
-            parsed_data["image_analysis"] = "Image analysis was not available, using simulated assessment"
+            try:
+                response = await generate_gemini_content([FLOOD_PROMPT, image_part])
+                parsed_data = parse_gemini_response(response.text)
+                if parsed_data is None:
+                    parsed_data = _default_gemini_payload(response.text)
+                else:
+                    # Only cache real parses so one bad reply is retried on the next upload
+                    _ANALYSIS_CACHE[cache_key] = parsed_data
+            except Exception as ai_error:
+                logger.error(f"Error calling Gemini AI: {str(ai_error)}")
+                parsed_data = generate_image_risk_assessment()
+                parsed_data["image_analysis"] = "Image analysis was not available, using simulated assessment"
 
         return {
             "success": True,
@@ -167,98 +312,105 @@ async def analyze_image(file: UploadFile = File(...)):
             "message": "Image analysis completed successfully using Gemini AI"
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing image: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-def generate_image_risk_assessment() -> dict:
-    """Generate simulated risk assessment for image analysis"""
-    risk_level = random.choice(["Low", "Medium", "High", "Very High"])
-    descriptions = {
-        "Low": "Image analysis shows low flood risk terrain.",
-        "Medium": "Image analysis indicates moderate flood risk factors.",
-        "High": "Image analysis reveals high flood risk characteristics.",
-        "Very High": "Image analysis shows very high flood risk indicators."
-    }
-    recommendations = {
-        "Low": [
+# Simulated assessments, built once rather than on every request
+_IMAGE_BASE = {
+    "Low": {
+        "risk_level": "Low",
+        "description": "Image analysis shows low flood risk terrain.",
+        "recommendations": (
             "Continue monitoring terrain changes",
             "Maintain current drainage systems",
             "Stay informed about weather patterns"
-        ],
-        "Medium": [
-            "Improve drainage infrastructure",
-            "Consider flood monitoring systems",
-            "Develop emergency response plan"
-        ],
-        "High": [
+        )
+    },
+    "Medium": {
+        "risk_level": "Medium",
+        "description": "Image analysis indicates moderate flood risk factors.",
+        "recommendations": _MEDIUM_RECOMMENDATIONS
+    },
+    "High": {
+        "risk_level": "High",
+        "description": "Image analysis reveals high flood risk characteristics.",
+        "recommendations": (
             "Install comprehensive flood barriers",
             "Implement early warning systems",
             "Consider structural reinforcements"
-        ],
-        "Very High": [
-            "Immediate flood protection measures needed",
-            "Consider relocation to higher ground",
-            "Implement comprehensive emergency protocols"
-        ]
+        )
+    },
+    "Very High": {
+        "risk_level": "Very High",
+        "description": "Image analysis shows very high flood risk indicators.",
+        "recommendations": _VERY_HIGH_RECOMMENDATIONS
     }
+}
 
+_COORD_BASE = {
+    "Low": {
+        "risk_level": "Low",
+        "description": "Coordinates indicate low flood risk terrain.",
+        "recommendations": _MONITOR_RECOMMENDATIONS
+    },
+    "Medium": {
+        "risk_level": "Medium",
+        "description": "Coordinates indicate moderate flood risk factors.",
+        "recommendations": _MEDIUM_RECOMMENDATIONS
+    },
+    "High": {
+        "risk_level": "High",
+        "description": "Coordinates indicate high flood risk potential.",
+        "recommendations": (
+            "Install flood barriers",
+            "Implement early warning systems",
+            "Consider structural reinforcements"
+        )
+    },
+    "Very High": {
+        "risk_level": "Very High",
+        "description": "Coordinates indicate very high flood risk area.",
+        "recommendations": _VERY_HIGH_RECOMMENDATIONS
+    }
+}
+
+def generate_image_risk_assessment() -> dict:
+    """Generate simulated risk assessment for image analysis"""
+    risk_level = _RNG.choice(_RISK_LEVELS)
     return {
-        "risk_level": risk_level,
-        "description": descriptions[risk_level],
-        "recommendations": recommendations[risk_level],
-        "elevation": round(random.uniform(10, 100), 1),
-        "distance_from_water": round(random.uniform(200, 2000), 1)
+        **_IMAGE_BASE[risk_level],
+        "elevation": round(_RNG.uniform(10, 100), 1),
+        "distance_from_water": round(_RNG.uniform(200, 2000), 1)
     }
 
+# Kept async: the handler does no blocking work, so a threadpool hand-off would only add overhead
 @app.post("/api/analyze/coordinates")
 async def analyze_coordinates(request: CoordinateRequest):
     """Analyze flood risk based on coordinates (latitude & longitude)"""
-    risk_level = random.choice(["Low", "Medium", "High", "Very High"])
-    descriptions = {
-        "Low": "Coordinates indicate low flood risk terrain.",
-        "Medium": "Coordinates indicate moderate flood risk factors.",
-        "High": "Coordinates indicate high flood risk potential.",
-        "Very High": "Coordinates indicate very high flood risk area."
-    }
-    recommendations = {
-        "Low": [
-            "Monitor weather conditions",
-            "Stay informed about local alerts"
-        ],
-        "Medium": [
-            "Improve drainage infrastructure",
-            "Consider flood monitoring systems",
-            "Develop emergency response plan"
-        ],
-        "High": [
-            "Install flood barriers",
-            "Implement early warning systems",
-            "Consider structural reinforcements"
-        ],
-        "Very High": [
-            "Immediate flood protection measures needed",
-            "Consider relocation to higher ground",
-            "Implement comprehensive emergency protocols"
-        ]
-    }
-
+    risk_level = _RNG.choice(_RISK_LEVELS)
     return {
         "success": True,
-        "risk_level": risk_level,
-        "description": descriptions[risk_level],
-        "recommendations": recommendations[risk_level],
-        "elevation": round(random.uniform(10, 100), 1),
-        "distance_from_water": round(random.uniform(200, 2000), 1),
+        **_COORD_BASE[risk_level],
+        "elevation": round(_RNG.uniform(10, 100), 1),
+        "distance_from_water": round(_RNG.uniform(200, 2000), 1),
         "message": "Coordinate-based analysis completed successfully"
     }
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
+    reload = os.environ.get("RELOAD", "false").lower() == "true"
     uvicorn.run(
-        "start:app",  # Make sure this filename matches your file
+        "main:app",
         host="0.0.0.0",
         port=port,
-        reload=True,
-        log_level="info"
+        # Each worker keeps its own Gemini client and analysis cache; uvicorn ignores workers when reloading
+        workers=int(os.environ.get("WORKERS", 1)),
+        reload=reload,
+        # uvloop and httptools are picked up automatically when installed
+        loop="auto",
+        http="auto",
+        log_level="warning"
     )
@@ -22,10 +22,17 @@ if __name__ == "__main__":
     print(f"  - ReDoc: http://{host}:{port}/redoc")
     print(f"  - OpenAPI JSON: http://{host}:{port}/openapi.json")
     
+    reload = os.getenv("RELOAD", "false").lower() == "true"
+    # Set RELOAD=true for development; WORKERS scales production deployments
+    workers = int(os.getenv("WORKERS", 1))
+    
     uvicorn.run(
         "main:app",
         host=host,
         port=port,
-        reload=True,
-        log_level="info"
+        workers=workers,
+        reload=reload,
+        loop="auto",
+        http="auto",
+        log_level="warning"
     ) 
\ No newline at end of file